@@ -1,14 +1,26 @@
 import functools
+import logging
+import dask.array as da
 import numpy as np
-import time
 
 import bigstream.transform as bs_transform
 import bigstream.io_utility as io_utility
 import bigstream.utility as ut
 
-from itertools import product
-
 from dask.distributed import as_completed
+from numcodecs import Blosc
+from toolz import partition_all
+
+
+# all corners of a 3d block: False selects the block start, True the end
+_CORNERS_3D = ut.block_corners(3)
+
+
+logger = logging.getLogger(__name__)
+
+
+# codec used for blocks sent compressed from the workers
+_BLOCK_CODEC = Blosc(cname='zstd', clevel=3, shuffle=Blosc.SHUFFLE)
 
 
 def distributed_apply_transform(
@@ -20,6 +32,8 @@ def distributed_apply_transform(
     overlap_factor=0.5,
     aligned_data=None,
     transform_spacing=None,
+    batch_size=1,
+    compress_blocks=False,
     **kwargs,
 ):
     """
@@ -43,7 +57,8 @@ def distributed_apply_transform(
         of the moving image. Length must equal `mov.ndim`
 
     blocksize : tuple
-        The block partition size used for distributing the work
+        The block partition size used for distributing the work.
+        It is rounded up to a multiple of the aligned_data chunks
 
     transform_list : list
         The list of transforms to apply. These may be 2d arrays of shape 4x4
@@ -55,8 +70,11 @@ def distributed_apply_transform(
     overlap_factor : float in range [0, 1] (default: 0.5)
         Block overlap size as a percentage of block size
 
-    aligned_data : ndarray (default: None)
-        A subpath in the zarr array to write the resampled data to
+    aligned_data : zarr array or ndarray (default: None)
+        The array to write the resampled data to. Zarr arrays stored in
+        a local directory are written by the workers in parallel, so
+        blocksize should be a multiple of their chunk shape. Any other
+        array is updated by the client
 
     transform_spacing : tuple
         Spacing to be applied for each transform. If not set
@@ -65,6 +83,18 @@ def distributed_apply_transform(
     cluster_client : Dask cluster client proxy
         the cluster must exists before this method is invoked
 
+    batch_size : int (default: 1)
+        Number of blocks processed by a single dask task. For small
+        blocks a larger batch (e.g. 10-50) amortizes the scheduler
+        overhead of each task. The blocks of a batch are also written
+        one after the other, so the writes run in parallel only across
+        batches, i.e. across concurrent tasks
+
+    compress_blocks : bool (default: False)
+        If True the transformed blocks are compressed with blosc/zstd
+        before they leave the worker that computed them. Useful when
+        blocks have to travel over a slow network to be written
+
     **kwargs : Any additional keyword arguments
         Passed to bigstream.transform.apply_transform
 
@@ -80,7 +110,11 @@ def distributed_apply_transform(
     fix_shape = fix.shape
     mov_shape = mov.shape
     blocksize_array = np.array(blocksize)
-    nblocks = np.ceil(np.array(fix_shape) / blocksize_array).astype(int)
+    # only zarr arrays in a local directory can be written by the workers
+    output_location = io_utility.get_zarr_location(aligned_data)
+    if output_location is not None:
+        blocksize_array = _align_blocksize_to_chunks(blocksize_array,
+                                                     aligned_data)
     overlaps = np.round(blocksize_array * overlap_factor).astype(int)
 
     # ensure there's a 1:1 correspondence between transform spacing 
@@ -99,60 +133,147 @@ def distributed_apply_transform(
         transform_spacing_list = transform_spacing
 
     # prepare block coordinates
-    blocks_coords = []
-    for (i, j, k) in np.ndindex(*nblocks):
-        start = blocksize_array * (i, j, k) - overlaps
-        stop = start + blocksize_array + 2 * overlaps
-        start = np.maximum(0, start)
-        stop = np.minimum(fix_shape, stop)
-        block_coords = tuple(slice(x, y) for x, y in zip(start, stop))
-        blocks_coords.append(block_coords)
-
-    print('Transform', len(blocks_coords), 'blocks',
-          'with partition size' ,blocksize_array,
-          flush=True)
-
-    fix_block_reader = functools.partial(io_utility.read_block, image=fix)
-    mov_block_reader = functools.partial(io_utility.read_block, image=mov)
-    transform_block = functools.partial(
-        _transform_single_block,
+    _, _, blocks_coords = ut.get_blocks_coords(fix_shape, blocksize_array,
+                                               overlaps)
+
+    blocks_coords_batches = list(partition_all(max(1, batch_size),
+                                               blocks_coords))
+
+    logger.info('Transform %d blocks with partition size %s in %d batches',
+                len(blocks_coords), blocksize_array,
+                len(blocks_coords_batches))
+
+    fix_block_reader = io_utility.get_array_reader(fix).__getitem__
+    mov_block_reader = io_utility.get_array_reader(mov).__getitem__
+    transform_blocks = functools.partial(
+        _transform_block_batch,
         fix_block_reader,
         mov_block_reader,
+        compress_blocks=compress_blocks,
         full_mov_shape=mov_shape,
         fix_spacing=fix_spacing,
         mov_spacing=mov_spacing,
         blocksize=blocksize_array,
         blockoverlaps=overlaps,
-        transform_list=transform_list,
         transform_spacing_list=transform_spacing_list,
-        *kwargs,
+        transform_spacing_array=np.array(
+            [np.broadcast_to(s, np.shape(fix_spacing))
+             for s in transform_spacing_list],
+            dtype=float,
+        ).reshape(-1, len(fix_spacing)),
+        **kwargs,
+    )
+
+    # send the transforms to every worker once
+    # rather than serializing them with every task
+    transform_list_futures = cluster_client.scatter(
+        [io_utility.get_array_reader(t, cache_chunks=True) if t.ndim > 2
+         else t for t in transform_list],
+        broadcast=True,
+        hash=False,
     )
 
     # apply transformation to all blocks
     transform_block_res = cluster_client.map(
-        transform_block,
-        blocks_coords,
+        transform_blocks,
+        blocks_coords_batches,
+        transform_list=transform_list_futures,
     )
 
-    for batch in as_completed(transform_block_res,
-                              with_results=True).batches():
-        for _, result in batch:
-            finished_block_coords, aligned_block = result
-
-            print('Transformed block:',
-                  finished_block_coords,
-                  flush=True)
-
-            if aligned_data is not None:
-                print('Update warped block:',
-                      finished_block_coords,
-                      '(', aligned_block.shape, ')',
-                      flush=True)
-                aligned_data[finished_block_coords] = aligned_block
-    print(f'{time.ctime(time.time())} Distributed deform transform applied successfully',
-            flush=True)
+    if output_location is None:
+        # in memory (or non zarr) outputs can only be updated by the client
+        for batch in as_completed(transform_block_res,
+                                  with_results=True).batches():
+            for _, results in batch:
+                for finished_block_coords, aligned_block in results:
+                    logger.debug('Transformed block: %s',
+                                 finished_block_coords)
+                    if aligned_data is not None:
+                        aligned_block = _decode_block(aligned_block)
+                        logger.debug('Update warped block: %s (%s)',
+                                     finished_block_coords,
+                                     aligned_block.shape)
+                        aligned_data[finished_block_coords] = aligned_block
+    else:
+        # the workers write the blocks in parallel
+        # so the warped data never transits through the client
+        write_block_res = cluster_client.map(
+            _write_block_batch,
+            transform_block_res,
+            output_location=output_location,
+        )
+        # transformed blocks are released as soon as they are written
+        del transform_block_res
+
+        for batch in as_completed(write_block_res,
+                                  with_results=True).batches():
+            for _, written_blocks_coords in batch:
+                for finished_block_coords in written_blocks_coords:
+                    logger.debug('Transformed block: %s',
+                                 finished_block_coords)
+    # cached deform chunks are only valid for this call
+    cluster_client.run(io_utility.clear_zarr_cache)
+    logger.info('Distributed deform transform applied successfully')
     
 
+def _align_blocksize_to_chunks(blocksize, output):
+    """
+    Round blocksize up to a multiple of the chunk (or shard) shape of the
+    output, so that parallel block writes never share a chunk and every
+    chunk is written once, without reading it back
+    """
+    chunks = getattr(output, 'shards', None) or output.chunks
+    chunks = np.array(chunks[:len(blocksize)])
+    aligned_blocksize = np.ceil(blocksize / chunks).astype(int) * chunks
+    if np.any(aligned_blocksize != blocksize):
+        logger.warning('blocksize %s is not a multiple of the output '
+                       'chunks %s - use %s instead',
+                       blocksize, chunks, aligned_blocksize)
+    return aligned_blocksize
+
+
+def _transform_block_batch(fix_block_read_method,
+                           mov_block_read_method,
+                           blocks_coords,
+                           compress_blocks=False,
+                           **kwargs):
+    """
+    Transform a batch of blocks in a single task
+    """
+    results = []
+    for block_coords in blocks_coords:
+        final_block_coords, aligned_block = _transform_single_block(
+            fix_block_read_method,
+            mov_block_read_method,
+            block_coords,
+            **kwargs,
+        )
+        if compress_blocks:
+            aligned_block = _encode_block(aligned_block)
+        results.append((final_block_coords, aligned_block))
+    return results
+
+
+def _encode_block(block):
+    """
+    Compress a block as (bytes, shape, dtype)
+    """
+    return (_BLOCK_CODEC.encode(np.ascontiguousarray(block)),
+            block.shape,
+            block.dtype.str)
+
+
+def _decode_block(block):
+    """
+    Decompress a block created by _encode_block,
+    uncompressed blocks are returned as they are
+    """
+    if not isinstance(block, tuple):
+        return block
+    data, shape, dtype = block
+    return np.frombuffer(_BLOCK_CODEC.decode(data), dtype=dtype).reshape(shape)
+
+
 def _transform_single_block(fix_block_read_method,
                             mov_block_read_method,
                             block_coords,
@@ -163,39 +284,39 @@ def _transform_single_block(fix_block_read_method,
                             blockoverlaps=None,
                             transform_list=[],
                             transform_spacing_list=[],
+                            transform_spacing_array=None,
                             **additional_transform_args):
     """
     Block transform function
     """
-    print('Transform block: ', block_coords, flush=True)
     # fetch fixed image slices and read fix
-    fix_origin = fix_spacing * [s.start for s in block_coords]
-    print('Block coords:',block_coords , 
-          'Block origin:', fix_origin,
-          'Block size:', blocksize,
-          'Overlap:', blockoverlaps,
-          flush=True)
+    block_starts = np.array([s.start for s in block_coords])
+    block_stops = np.array([s.stop for s in block_coords])
+    fix_origin = fix_spacing * block_starts
+    logger.debug('Transform block: %s, origin: %s, size: %s, overlap: %s',
+                 block_coords, fix_origin, blocksize, blockoverlaps)
     fix_block = fix_block_read_method(block_coords);
 
     # read relevant region of transforms
+    # the regions of all transforms are computed together
+    transforms_starts = np.floor(fix_origin /
+                                 transform_spacing_array).astype(int)
+    transforms_stops = np.ceil(block_stops * fix_spacing /
+                               transform_spacing_array).astype(int)
     applied_transform_list = []
     transform_origin = [fix_origin,] * len(transform_list)
     for iii, transform in enumerate(transform_list):
         if transform.shape != (4, 4):
-            start = np.floor(fix_origin / transform_spacing_list[iii]).astype(int)
-            stop = [s.stop for s in block_coords] * fix_spacing / transform_spacing_list[iii]
-            stop = np.ceil(stop).astype(int)
-            transform = transform[tuple(slice(a, b) for a, b in zip(start, stop))]
-            transform_origin[iii] = start * transform_spacing_list[iii]
+            start = transforms_starts[iii]
+            transform = transform[tuple(map(slice, start.tolist(),
+                                            transforms_stops[iii].tolist()))]
+            transform_origin[iii] = start * transform_spacing_array[iii]
         applied_transform_list.append(transform)
     transform_origin = tuple(transform_origin)
 
     # transform fixed block corners, read moving data
-    fix_block_coords = []
-    for corner in list(product([0, 1], repeat=3)):
-        a = [x.stop-1 if y else x.start for x, y in zip(block_coords, corner)]
-        fix_block_coords.append(a)
-    fix_block_coords = np.array(fix_block_coords) * fix_spacing
+    fix_block_coords = (np.where(_CORNERS_3D, block_stops - 1, block_starts) *
+                        fix_spacing)
 
     mov_block_coords = bs_transform.apply_transform_to_coordinates(
         fix_block_coords,
@@ -203,24 +324,19 @@ def _transform_single_block(fix_block_read_method,
         transform_spacing_list,
         transform_origin,
     )
-    print('Transformed moving block coords:', block_coords, 
-          fix_block_coords, '->', mov_block_coords,
-          flush=True)
-
-    mov_block_coords = np.round(mov_block_coords / mov_spacing).astype(int)
-    mov_block_coords = np.maximum(0, mov_block_coords)
-    mov_block_coords = np.minimum(full_mov_shape, mov_block_coords)
-    print('Rounded transformed moving block coords:', block_coords, '->', mov_block_coords,
-          flush=True)
-
-    mov_start = np.min(mov_block_coords, axis=0)
-    mov_stop = np.max(mov_block_coords, axis=0)
-    mov_slices = tuple(slice(a, b) for a, b in zip(mov_start, mov_stop))
-    mov_origin = mov_spacing * [s.start for s in mov_slices]
-    print('Moving block origin:', fix_origin, '->', mov_origin,
-          flush=True)
-    print('Moving block coords:', block_coords, '->', mov_slices,
-          flush=True)
+    logger.debug('Transformed moving block coords: %s %s -> %s',
+                 block_coords, fix_block_coords, mov_block_coords)
+
+    # round and clip in place, then take the bounding box
+    mov_block_coords = np.rint(mov_block_coords / mov_spacing)
+    np.clip(mov_block_coords, 0, full_mov_shape, out=mov_block_coords)
+    mov_block_coords = mov_block_coords.astype(int)
+    mov_start = mov_block_coords.min(axis=0)
+    mov_stop = mov_block_coords.max(axis=0)
+    mov_slices = tuple(map(slice, mov_start.tolist(), mov_stop.tolist()))
+    mov_origin = mov_spacing * mov_start
+    logger.debug('Moving block: %s -> %s, origin: %s -> %s',
+                 block_coords, mov_slices, fix_origin, mov_origin)
     mov_block = mov_block_read_method(mov_slices)
 
     # resample
@@ -233,43 +349,36 @@ def _transform_single_block(fix_block_read_method,
         mov_origin=mov_origin,
         **additional_transform_args,
     )
-    print('Warped block',
-          block_coords, '->', mov_slices,
-          'shape:', aligned_block.shape,
-          flush=True)
+    logger.debug('Warped block %s -> %s shape: %s',
+                 block_coords, mov_slices, aligned_block.shape)
 
     # crop out overlap
-    final_block_coords_list = []
-    for axis in range(aligned_block.ndim):
-        # left side
-        slc = [slice(None),]*aligned_block.ndim
-        start = block_coords[axis].start
-        stop = block_coords[axis].stop
-        if block_coords[axis].start != 0:
-            slc[axis] = slice(blockoverlaps[axis], None)
-            print('Crop axis', axis, 'left', 
-                  block_coords,'->',slc,
-                  flush=True)
-            aligned_block = aligned_block[tuple(slc)]
-            start = start+blockoverlaps[axis]
-
-        # right side
-        slc = [slice(None),]*aligned_block.ndim
-        if aligned_block.shape[axis] > blocksize[axis]:
-            slc[axis] = slice(None, blocksize[axis])
-            print('Crop axis', axis, 'right', block_coords,'->',slc,
-                  flush=True)
-            aligned_block = aligned_block[tuple(slc)]
-            stop = start + aligned_block.shape[axis]
-
-        final_block_coords_list.append(slice(start, stop))
-    # convert the coords to a tuple
-    final_block_coords = tuple(final_block_coords_list)
-    print('Aligned block coords:', block_coords, '->', final_block_coords)
+    crop_slices, final_block_coords = _get_crop_coords(block_coords,
+                                                       blocksize,
+                                                       blockoverlaps)
+    aligned_block = aligned_block[crop_slices]
+    logger.debug('Aligned block coords: %s -> %s',
+                 block_coords, final_block_coords)
     # return result
     return final_block_coords, aligned_block
 
 
+def _get_crop_coords(block_coords, blocksize, blockoverlaps):
+    """
+    Slices that crop the overlaps out of a block in a single view
+    and the coordinates of the cropped block in the full image
+    """
+    starts = np.array([s.start for s in block_coords])
+    stops = np.array([s.stop for s in block_coords])
+    lo = np.where(starts > 0, blockoverlaps, 0)
+    hi = lo + np.minimum(stops - starts - lo, blocksize)
+    crop_slices = tuple(map(slice, lo.tolist(), hi.tolist()))
+    final_block_coords = tuple(map(slice,
+                                   (starts + lo).tolist(),
+                                   (starts + hi).tolist()))
+    return crop_slices, final_block_coords
+
+
 def distributed_apply_transform_to_coordinates(
     coordinates,
     transform_list,
@@ -277,6 +386,7 @@ def distributed_apply_transform_to_coordinates(
     cluster_client,
     coords_spacing=None,
     coords_origin=None,
+    dtype=np.float32,
 ):
     """
     Move a set of coordinates through a list of transforms
@@ -315,59 +425,57 @@ def distributed_apply_transform_to_coordinates(
     cluster_client : Dask cluster client proxy
         the cluster must exists before this method is invoked
 
+    dtype : numpy.dtype (default: np.float32)
+        The precision used to transform the coordinates. Single precision
+        is enough for voxel scale coordinates and halves the memory traffic;
+        use np.float64 if more precision is needed. Only the first 3 columns
+        are cast; any other columns (e.g. ids) keep the input precision
+
     Returns
     -------
     transformed_coordinates : Nxd array
         The given coordinates transformed by the given transform_list
     """
 
+    coordinates = np.asarray(coordinates)
+
     # determine partitions of coordinates
     phys_blocksize = np.array(voxel_blocksize)*coords_spacing[::-1]
     min_coord = np.min(coordinates[:, 0:3], axis=0)
     max_coord = np.max(coordinates[:, 0:3], axis=0)
     vol_size = max_coord - min_coord
     nblocks = np.ceil(vol_size / phys_blocksize + 1).astype(int)
-    print(f'{time.ctime(time.time())}',
-          'Min coords:', min_coord,
-          'Max coords:', max_coord,
-          'Block size:', voxel_blocksize,
-          'Phys block size:', phys_blocksize,
-          'Vol size:', vol_size,
-          'Voxel spacing:', coords_spacing,
-          'NBlocks:', nblocks,
-          flush=True)
-    blocks_indexes = []
-    blocks_slices = []
-    blocks_origins = []
-    blocks_points, blocks_points_indexes = [], []
-    for (i, j, k) in np.ndindex(*nblocks):
-        block_index = (i, j, k)
-        block_start = voxel_blocksize * np.array(block_index)
-        block_stop = block_start + voxel_blocksize
-        block_slice_coords = tuple(slice(x, y) for x, y in zip(block_start, block_stop))
-        lower_bound = min_coord + phys_blocksize * np.array(block_index)
-        upper_bound = lower_bound + phys_blocksize
-        print(f'{time.ctime(time.time())}',
-              f'Get points for block {block_index}: {block_slice_coords}',
-              f'from {lower_bound} to {upper_bound}',
-              flush=True)
-        not_too_low = np.all(coordinates[:, 0:3] >= lower_bound, axis=1)
-        not_too_high = np.all(coordinates[:, 0:3] < upper_bound, axis=1)
-        point_indexes = np.nonzero(not_too_low * not_too_high)[0]
-        if point_indexes.size > 0:
-            print(f'{time.ctime(time.time())}',
-                  f'Add {point_indexes.size} to block {block_index}',
-                  flush=True)
-            blocks_indexes.append(block_index)
-            blocks_slices.append(block_slice_coords)
-            blocks_origins.append(lower_bound)
-            blocks_points.append(coordinates[point_indexes])
-            blocks_points_indexes.append(point_indexes)
-        else:
-            print(f'{time.ctime(time.time())}',
-                  f'No point added to block {block_index}',
-                  flush=True)
+    logger.info('Min coords: %s, Max coords: %s, Block size: %s, '
+                'Phys block size: %s, Vol size: %s, Voxel spacing: %s, '
+                'NBlocks: %s',
+                min_coord, max_coord, voxel_blocksize, phys_blocksize,
+                vol_size, coords_spacing, nblocks)
+    # assign every point to its block in a single pass
+    blocks_indexes_array, blocks_points_indexes = ut.partition_coordinates(
+        coordinates[:, 0:3],
+        min_coord,
+        phys_blocksize,
+        nblocks,
+    )
+    blocks_starts = blocks_indexes_array * np.array(voxel_blocksize)
+    blocks_stops = blocks_starts + voxel_blocksize
+    blocks_indexes = [tuple(index) for index in blocks_indexes_array.tolist()]
+    blocks_slices = [tuple(map(slice, start, stop))
+                     for start, stop in zip(blocks_starts.tolist(),
+                                            blocks_stops.tolist())]
+    blocks_origins = list(min_coord + phys_blocksize * blocks_indexes_array)
+    blocks_points = [coordinates[point_indexes]
+                     for point_indexes in blocks_points_indexes]
+    logger.info('Partitioned %d points into %d non empty blocks',
+                len(coordinates), len(blocks_indexes))
     original_points_indexes = np.concatenate(blocks_points_indexes, axis=0)
+    # send the transforms to every worker once
+    transform_list_futures = cluster_client.scatter(
+        [io_utility.get_array_reader(t, cache_chunks=True) if t.ndim > 2
+         else t for t in transform_list],
+        broadcast=True,
+        hash=False,
+    )
     # transform all partitions and return
     futures = cluster_client.map(
         _transform_coords,
@@ -376,9 +484,12 @@ def distributed_apply_transform_to_coordinates(
         blocks_origins,
         blocks_points,
         coords_spacing=coords_spacing,
-        transform_list=transform_list,
+        transform_list=transform_list_futures,
+        dtype=dtype,
     )
     transform_results = np.concatenate(cluster_client.gather(futures), axis=0)
+    # cached deform chunks are only valid for this call
+    cluster_client.run(io_utility.clear_zarr_cache)
     # maintain the same order for the warped results
     results = np.empty_like(transform_results)
     results[original_points_indexes] = transform_results
@@ -390,58 +501,59 @@ def _transform_coords(block_index,
                       block_origin,
                       coord_indexed_values,
                       coords_spacing=None,
-                      transform_list=[]):
+                      transform_list=[],
+                      dtype=np.float32):
     # read relevant region of transform
-    print(f'{time.ctime(time.time())} Apply block {block_index} transform ',
-          'block origin', block_origin,
-          'block slice coords', block_slice_coords,
-          'to', len(coord_indexed_values), 'points',
-          flush=True)
-
-    points_coords = coord_indexed_values[:, 0:3]
+    logger.debug('Apply block %s transform, block origin %s, '
+                 'block slice coords %s to %d points',
+                 block_index, block_origin, block_slice_coords,
+                 len(coord_indexed_values))
+
+    # transforms are applied in the requested precision, while the values
+    # that come with the points are returned in their own precision
+    points_coords = coord_indexed_values[:, 0:3].astype(dtype, copy=False)
     points_values = coord_indexed_values[:, 3:]
 
+    block_starts = np.array([s.start for s in block_slice_coords])
+    block_stops = np.array([s.stop for s in block_slice_coords])
+
     cropped_transforms = []
-    for _, transform in enumerate(transform_list):
+    for transform in transform_list:
         if transform.shape != (4, 4):
-            crop_slices = []
-            for axis in range(transform.ndim-1):
-                start = block_slice_coords[axis].start
-                stop = block_slice_coords[axis].stop
-                if transform.shape[axis] < stop:
-                    crop_slices.append(slice(start, transform.shape[axis]))
-                else:
-                    crop_slices.append(slice(start, stop))
-            print(f'{time.ctime(time.time())} Crop transform {block_index}: ',
-                f'to {crop_slices} from {transform.shape}',
-                flush=True)
+            crop_stops = np.minimum(block_stops, transform.shape[:-1])
+            crop_slices = tuple(map(slice, block_starts.tolist(),
+                                    crop_stops.tolist()))
+            logger.debug('Crop transform %s: to %s from %s',
+                         block_index, crop_slices, transform.shape)
             # for vector displacement fields crop the transformation
-            cropped_transforms.append(transform[tuple(crop_slices)])
+            cropped_transforms.append(
+                np.asarray(transform[crop_slices], dtype=dtype))
         else:
             # no need to do any cropping if it's an affine matrix
-            cropped_transforms.append(transform)
+            cropped_transforms.append(np.asarray(transform, dtype=dtype))
 
     # apply transforms
     warped_coords = bs_transform.apply_transform_to_coordinates(
         points_coords,
         cropped_transforms,
-        transform_spacing=coords_spacing,
-        transform_origin=block_origin[::-1]
+        transform_spacing=np.asarray(coords_spacing, dtype=dtype),
+        transform_origin=np.asarray(block_origin[::-1], dtype=dtype),
     )
 
-    warped_coord_indexed_values = np.empty_like(coord_indexed_values)
-    # flipped the zyx warped coords back to xyz
-    warped_coord_indexed_values[:, 0:3] = warped_coords[:, 0:3]
-    warped_coord_indexed_values[:, 3:] = points_values
+    # a single allocation for the warped coords and their values
+    warped_coord_indexed_values = np.concatenate(
+        [warped_coords[:, 0:3], points_values],
+        axis=1,
+        dtype=np.result_type(coord_indexed_values.dtype, dtype),
+    )
 
     min_warped_coord = np.min(warped_coord_indexed_values[:, 0:3], axis=0)
     max_warped_coord = np.max(warped_coord_indexed_values[:, 0:3], axis=0)
 
-    print(f'{time.ctime(time.time())} Finished block: ', block_index,
-          f'- warped {warped_coord_indexed_values.shape} coords',
-          f'min warped coord {min_warped_coord}',
-          f'max warped coord {max_warped_coord}',
-          flush=True)
+    logger.debug('Finished block: %s - warped %s coords, '
+                 'min warped coord %s, max warped coord %s',
+                 block_index, warped_coord_indexed_values.shape,
+                 min_warped_coord, max_warped_coord)
 
     return warped_coord_indexed_values
 
@@ -471,7 +583,8 @@ def distributed_invert_displacement_vector_field(
         The physical voxel spacing of the displacement field
 
     blocksize : tuple
-        The shape of blocks in voxels
+        The shape of blocks in voxels. It is rounded up to a multiple
+        of the inv_vectorfield_array chunks
 
     inv_vectorfield_array : zarr array
         The inverse vector field
@@ -500,59 +613,44 @@ def distributed_invert_displacement_vector_field(
     """
 
     # get overlap and number of blocks
-    blocksize_array = np.array(blocksize)
+    blocksize_array = _align_blocksize_to_chunks(np.array(blocksize),
+                                                 inv_vectorfield_array)
     overlap = np.round(blocksize_array * overlap_factor).astype(int)
-    nblocks = np.ceil(np.array(vectorfield_array.shape[:-1]) / 
-                      blocksize_array).astype(int)
-
-    # store block coordinates in a dask array
-    blocks_coords = []
-    for (i, j, k) in np.ndindex(*nblocks):
-        start = blocksize_array * (i, j, k) - overlap
-        stop = start + blocksize_array + 2 * overlap
-        start = np.maximum(0, start)
-        stop = np.minimum(vectorfield_array.shape[:-1], stop)
-        coords = tuple(slice(x, y) for x, y in zip(start, stop))
-        blocks_coords.append(coords)
-
-    # invert all blocks
-    print(f'{time.ctime(time.time())} Invert', len(blocks_coords), 'blocks',
-          'with partition size', blocksize_array,
-          flush=True)
-
-    invert_res = cluster_client.map(
+
+    # blocks with overlaps are read, inverted and trimmed by map_overlap
+    vectorfield = da.from_array(
+        vectorfield_array,
+        chunks=tuple(blocksize_array) + (vectorfield_array.shape[-1],),
+    )
+    nblocks = np.prod(vectorfield.numblocks)
+    logger.info('Invert %d blocks with partition size %s',
+                nblocks, blocksize_array)
+
+    inverse = da.map_overlap(
         _invert_block,
-        blocks_coords,
-        full_vectorfield=vectorfield_array,
+        vectorfield,
+        depth=tuple(overlap) + (0,),
+        boundary='none',
+        trim=True,
+        dtype=vectorfield.dtype,
         spacing=spacing,
-        blocksize=blocksize_array,
-        blockoverlaps=overlap,
+        step=step,
         iterations=iterations,
         sqrt_order=sqrt_order,
         sqrt_step=sqrt_step,
         sqrt_iterations=sqrt_iterations,
     )
+    # writes are lock free only if every block maps to whole output chunks
+    inverse = inverse.rechunk(inv_vectorfield_array.chunks)
 
-    write_invert_res = cluster_client.map(
-        _write_block,
-        invert_res,
-        output=inv_vectorfield_array
-    )
-
-    for batch in as_completed(write_invert_res, with_results=True).batches():
-        for _, result in batch:
-            block_coords = result
+    cluster_client.compute(
+        da.store(inverse, inv_vectorfield_array, lock=False, compute=False)
+    ).result()
+    logger.info('Inverted %d blocks', nblocks)
 
-            print(f'{time.ctime(time.time())} Finished inverting block:',
-                  block_coords,
-                  flush=True)
 
-
-def _invert_block(block_coords,
-                  full_vectorfield=None,
+def _invert_block(block_vectorfield,
                   spacing=None,
-                  blocksize=None,
-                  blockoverlaps=None,
                   step=0.5,
                   iterations=10,
                   sqrt_order=2,
@@ -561,10 +659,8 @@ def _invert_block(block_coords,
     """
     Invert block function
     """
-    print('Invert block:', block_coords, flush=True)
-
-    block_vectorfield = full_vectorfield[block_coords]
-    inverse_block = bs_transform.invert_displacement_vector_field(
+    logger.debug('Invert block of shape %s', block_vectorfield.shape)
+    return bs_transform.invert_displacement_vector_field(
         block_vectorfield,
         spacing,
         step=step,
@@ -574,50 +670,20 @@ def _invert_block(block_coords,
         sqrt_iterations=sqrt_iterations,
     )
 
-    print('Computed inverse field for block', 
-          block_coords, block_vectorfield.shape,
-          '->',
-          inverse_block.shape,
-          flush=True)
-    # crop out overlap
-    inverse_block_coords_list = []
-    for axis in range(inverse_block.ndim - 1):
-        # left side
-        slc = [slice(None),]*(inverse_block.ndim - 1)
-        start = block_coords[axis].start
-        stop = block_coords[axis].stop
-        if block_coords[axis].start != 0:
-            slc[axis] = slice(blockoverlaps[axis], None)
-            inverse_block = inverse_block[tuple(slc)]
-            start = start+blockoverlaps[axis]
-
-        # right side
-        slc = [slice(None),]*(inverse_block.ndim - 1)
-        if inverse_block.shape[axis] > blocksize[axis]:
-            slc[axis] = slice(None, blocksize[axis])
-            inverse_block = inverse_block[tuple(slc)]
-            stop = start + inverse_block.shape[axis]
-
-        inverse_block_coords_list.append(slice(start, stop))
-
-    inverse_block_coords = tuple(inverse_block_coords_list)
-    print('Completed inverse vector field for block', 
-          block_coords, block_vectorfield.shape,
-          '->',
-          inverse_block_coords, inverse_block.shape,
-          flush=True)
-    # return result
-    return inverse_block_coords, inverse_block
 
-
-def _write_block(block, output=None):
+def _write_block(block, output_location=None):
     block_coords, block_data = block
 
-    if output is not None:
-        print(f'{time.ctime(time.time())} Write block:',
-                block_coords,
-                '(', block_data.shape, ')',
-                flush=True)
-        output[block_coords] = block_data
+    if output_location is not None:
+        block_data = _decode_block(block_data)
+        logger.debug('Write block: %s (%s)', block_coords, block_data.shape)
+        io_utility.write_zarr_block(block_coords, block_data,
+                                    **output_location)
 
     return block_coords
+
+
+def _write_block_batch(blocks, output_location=None):
+    write_block = functools.partial(_write_block,
+                                    output_location=output_location)
+    return [write_block(block) for block in blocks]
@@ -1,5 +1,7 @@
+import functools
 import os
 import nrrd
+import uuid
 import numpy as np
 import zarr
 
@@ -130,6 +132,167 @@ def read_block(block_coords, image=None, image_path=None, image_subpath=None):
     return None
 
 
+def get_zarr_location(image):
+    """
+    Return the location of a zarr (or N5) array stored in a local directory
+    as the keyword arguments of read_zarr_block, or None if the image
+    is not such an array. The location includes a new cache key on every
+    call, so that workers never reuse an array opened for an earlier call
+    """
+    if (isinstance(image, zarr.Array) and
+        isinstance(image.store, zarr.DirectoryStore)):
+        return {
+            'container_path': image.store.path,
+            'subpath': image.path,
+            'data_store_name': ('n5' if isinstance(image.store, zarr.N5Store)
+                                else 'zarr'),
+            'cache_key': uuid.uuid4().hex,
+        }
+    return None
+
+
+def read_zarr_block(block_coords, container_path=None, subpath=None,
+                    data_store_name=None, cache_key=None):
+    """
+    Read a block from a zarr (or N5) container. If a cache_key is given
+    the container is opened only once per process and cache_key, so that
+    workers reading many blocks of the same array do not reload its
+    metadata for every block
+    """
+    if cache_key is None:
+        image = _open_zarr_array(container_path, subpath, data_store_name)
+    else:
+        image = _open_cached_zarr(container_path, subpath, data_store_name,
+                                  cache_key)
+    return image[block_coords] if block_coords is not None else image
+
+
+def write_zarr_block(block_coords, block, container_path=None, subpath=None,
+                     data_store_name=None, cache_key=None):
+    """
+    Write a block to a zarr (or N5) container given by its location.
+    The container is reopened for every write, so cache_key is ignored
+    """
+    image = _open_zarr_array(container_path, subpath, data_store_name,
+                             mode='r+')
+    image[block_coords] = block
+
+
+def get_array_reader(image, cache_chunks=False):
+    """
+    Return the image as it should be sent to the workers that read its blocks.
+    Zarr (or N5) arrays stored in a local directory are replaced by
+    a CachedZarrArray, optionally caching their decoded chunks. Any other
+    array is returned as is
+    """
+    zarr_location = get_zarr_location(image)
+    if zarr_location is None:
+        return image
+    return CachedZarrArray(cache_chunks=cache_chunks, **zarr_location)
+
+
+class CachedZarrArray:
+    """
+    Read-only reference to a zarr (or N5) array stored in a local directory.
+    It is serialized as the array location only and the array is reopened
+    once per process. With cache_chunks, blocks are assembled from decoded
+    chunks kept in a per process LRU cache, so that overlapping blocks read
+    by the same worker, e.g. from a deformation, decode each chunk only once.
+    Create it with the location returned by get_zarr_location.
+    Cached arrays and chunks are keyed on a token unique to each reference,
+    so an array rewritten at the same location is never read stale;
+    run clear_zarr_cache on the workers once the reference is no longer used
+    """
+
+    def __init__(self, container_path=None, subpath=None,
+                 data_store_name=None, cache_key=None, cache_chunks=True):
+        self.container_path = container_path
+        self.subpath = subpath
+        self.data_store_name = data_store_name
+        self.cache_key = cache_key or uuid.uuid4().hex
+        self.cache_chunks = cache_chunks
+
+    @property
+    def array(self):
+        return _open_cached_zarr(self.container_path, self.subpath,
+                                 self.data_store_name, self.cache_key)
+
+    @property
+    def shape(self):
+        return self.array.shape
+
+    @property
+    def ndim(self):
+        return self.array.ndim
+
+    @property
+    def dtype(self):
+        return self.array.dtype
+
+    def __getitem__(self, block_coords):
+        image = self.array
+        if not self.cache_chunks:
+            return image[block_coords]
+        if not isinstance(block_coords, tuple):
+            block_coords = (block_coords,)
+        if not all(isinstance(s, slice) and s.step in (None, 1)
+                   for s in block_coords):
+            return image[block_coords]
+        block_coords = block_coords + (slice(None),) * (image.ndim -
+                                                        len(block_coords))
+        bounds = [s.indices(n)[:2] for s, n in zip(block_coords, image.shape)]
+        starts = np.array([a for a, _ in bounds])
+        stops = np.maximum(starts, [b for _, b in bounds])
+        block = np.empty(stops - starts, dtype=image.dtype)
+        if block.size == 0:
+            return block
+
+        chunks = np.array(image.chunks)
+        first_chunk = starts // chunks
+        last_chunk = (stops - 1) // chunks
+        for chunk_index in np.ndindex(*(last_chunk - first_chunk + 1)):
+            chunk_index = first_chunk + chunk_index
+            chunk_start = chunk_index * chunks
+            chunk = _read_cached_chunk(self.container_path, self.subpath,
+                                       self.data_store_name, self.cache_key,
+                                       tuple(chunk_index.tolist()))
+            lo = np.maximum(starts, chunk_start)
+            hi = np.minimum(stops, chunk_start + chunk.shape)
+            block[tuple(map(slice, lo - starts, hi - starts))] = \
+                chunk[tuple(map(slice, lo - chunk_start, hi - chunk_start))]
+        return block
+
+
+def clear_zarr_cache():
+    """
+    Release the zarr chunks and arrays cached in this process, e.g. on every
+    worker with client.run once a distributed computation is finished
+    """
+    _read_cached_chunk.cache_clear()
+    _open_cached_zarr.cache_clear()
+
+
+@functools.lru_cache(maxsize=16)
+def _read_cached_chunk(data_path, data_subpath, data_store_name, cache_key,
+                       chunk_index):
+    image = _open_cached_zarr(data_path, data_subpath, data_store_name,
+                              cache_key)
+    return image.blocks[chunk_index]
+
+
+@functools.lru_cache(maxsize=32)
+def _open_cached_zarr(data_path, data_subpath, data_store_name, cache_key):
+    # cache_key is only part of the cache key, it scopes arrays to one call
+    return _open_zarr_array(data_path, data_subpath, data_store_name)
+
+
+def _open_zarr_array(data_path, data_subpath, data_store_name, mode='r'):
+    data_container = zarr.open(store=_get_data_store(data_path,
+                                                     data_store_name),
+                               mode=mode)
+    return data_container[data_subpath] if data_subpath else data_container
+
+
 def _open_zarr(data_path, data_subpath, data_store_name=None, block_coords=None):
     try:
         data_container = zarr.open(store=_get_data_store(data_path,
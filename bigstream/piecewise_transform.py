@@ -1,6 +1,6 @@
 import numpy as np
-from itertools import product
 import bigstream.utility as ut
+import bigstream.io_utility as io_utility
 import os, tempfile
 from ClusterWrap.decorator import cluster
 import dask.array as da
@@ -19,6 +19,7 @@ def distributed_apply_transform(
     overlap=0.5,
     dataset_path=None,
     temporary_directory=None,
+    deform_dtype=None,
     cluster=None,
     cluster_kwargs={},
     **kwargs,
@@ -64,6 +65,12 @@ def distributed_apply_transform(
         A parent directory for temporary data written to disk during computation
         If None then the current directory is used
 
+    deform_dtype : a numpy.dtype object (default: None)
+        The data type of the temporary zarr copies made of deformations given
+        as numpy arrays, e.g. np.float16 to halve the data read for every block.
+        Deformations are cast back to at least single precision when read.
+        If None the deformations keep their own data type.
+
     cluster : ClusterWrap.cluster object (default: None)
         Only set if you have constructed your own static cluster. The default behavior
         is to construct a cluster for the duration of this function, then close it
@@ -102,7 +109,9 @@ def distributed_apply_transform(
     for iii, transform in enumerate(transform_list):
         if transform.shape != (4, 4):
             zarr_path = temporary_directory.name + f'/deform{iii}.zarr'
-            transform = ut.numpy_to_zarr(transform, zarr_blocks, zarr_path)
+            transform = ut.numpy_to_zarr(
+                transform, zarr_blocks, zarr_path, dtype=deform_dtype,
+            )
         new_list.append(transform)
     transform_list = new_list
 
@@ -117,55 +126,95 @@ def distributed_apply_transform(
     overlap = np.round(blocksize * overlap).astype(int)  # NOTE: default overlap too big?
     nblocks = np.ceil(np.array(fix_zarr.shape) / blocksize).astype(int)
 
-    # store block coordinates in a dask array
-    # TODO: remove use of dask array
-    block_coords = np.empty(nblocks, dtype=tuple)
-    for (i, j, k) in np.ndindex(*nblocks):
-        start = blocksize * (i, j, k) - overlap
+    # determine block coordinates and the region of each deform a block needs
+    block_coords = {}
+    for index in np.ndindex(*nblocks):
+        start = blocksize * index - overlap
         stop = start + blocksize + 2 * overlap
         start = np.maximum(0, start)
         stop = np.minimum(fix_zarr.shape, stop)
-        block_coords[i, j, k] = tuple(slice(x, y) for x, y in zip(start, stop))
-    block_coords = da.from_array(block_coords, chunks=(1,)*block_coords.ndim)
-
-    # pipeline to run on each block
-    def transform_single_block(coords, transform_list):
-
-        # fetch fixed image slices and read fix
-        fix_slices = coords.item()
-        fix = fix_zarr[fix_slices]
-        fix_origin = fix_spacing * [s.start for s in fix_slices]
-
-        # read relevant region of transforms
-        new_list = []
+        fix_slices = tuple(slice(x, y) for x, y in zip(start, stop))
+        fix_origin = fix_spacing * start
+        transform_slices = [None,] * len(transform_list)
         transform_origin = [fix_origin,] * len(transform_list)
         for iii, transform in enumerate(transform_list):
             if transform.shape != (4, 4):
-                start = np.floor(fix_origin / kwargs['transform_spacing'][iii]).astype(int)
-                stop = [s.stop for s in fix_slices] * fix_spacing / kwargs['transform_spacing'][iii]
-                stop = np.ceil(stop).astype(int)
-                transform = transform[tuple(slice(a, b) for a, b in zip(start, stop))]
-                transform_origin[iii] = start * kwargs['transform_spacing'][iii]
-            new_list.append(transform)
-        transform_list = new_list
-        transform_origin = tuple(transform_origin)
-
-        # transform fixed block corners, read moving data
-        fix_block_coords = []
-        for corner in list(product([0, 1], repeat=3)):
-            a = [x.stop-1 if y else x.start for x, y in zip(fix_slices, corner)]
-            fix_block_coords.append(a)
-        fix_block_coords = np.array(fix_block_coords) * fix_spacing
+                spacing = kwargs['transform_spacing'][iii]
+                a = np.floor(fix_origin / spacing).astype(int)
+                b = np.ceil(stop * fix_spacing / spacing).astype(int)
+                transform_slices[iii] = tuple(slice(x, y) for x, y in zip(a, b))
+                transform_origin[iii] = a * spacing
+        block_coords[index] = (
+            fix_slices, transform_slices, tuple(transform_origin),
+        )
+
+    # workers read the zarr arrays by location rather than from a pickled copy
+    fix_reader = io_utility.get_array_reader(fix_zarr).__getitem__
+    mov_reader = io_utility.get_array_reader(mov_zarr).__getitem__
+    mov_shape = mov_zarr.shape
+    transform_readers = [
+        t if t.shape == (4, 4) else
+        io_utility.get_array_reader(t, cache_chunks=True).__getitem__
+        for t in transform_list
+    ]
+
+    # the region of the output every block is cropped to
+    block_indices, output_slices, _ = ut.get_blocks_coords(
+        fix_zarr.shape, blocksize,
+    )
+    output_slices = dict(zip(map(tuple, block_indices.tolist()), output_slices))
+
+    # which of start or stop-1 each block corner takes along each axis
+    corners = ut.block_corners(fix_zarr.ndim)
+
+    # if all transforms are affine, find the moving region of every block
+    # on the driver by transforming all block corners in one call
+    mov_block_slices = {index: None for index in block_coords.keys()}
+    if all(t.shape == (4, 4) for t in transform_list):
+        fix_start = np.array([[s.start for s in c[0]] for c in block_coords.values()])
+        fix_stop = np.array([[s.stop for s in c[0]] for c in block_coords.values()])
+        fix_block_coords = np.where(
+            corners, fix_stop[:, None] - 1, fix_start[:, None],
+        ) * fix_spacing
         mov_block_coords = bs_transform.apply_transform_to_coordinates(
-            fix_block_coords, transform_list, kwargs['transform_spacing'], transform_origin,
+            fix_block_coords.reshape(-1, fix_block_coords.shape[-1]), transform_list,
+        ).reshape(fix_block_coords.shape)
+        mov_start, mov_stop = _get_moving_bounds(
+            mov_block_coords, mov_spacing, mov_shape,
         )
-        mov_block_coords = np.round(mov_block_coords / mov_spacing).astype(int)
-        mov_block_coords = np.maximum(0, mov_block_coords)
-        mov_block_coords = np.minimum(mov_zarr.shape, mov_block_coords)
-        mov_start = np.min(mov_block_coords, axis=0)
-        mov_stop = np.max(mov_block_coords, axis=0)
-        mov_slices = tuple(slice(a, b) for a, b in zip(mov_start, mov_stop))
-        mov = mov_zarr[mov_slices]
+        for index, a, b in zip(block_coords.keys(), mov_start, mov_stop):
+            mov_block_slices[index] = tuple(slice(x, y) for x, y in zip(a, b))
+
+    # pipeline to run on each block
+    def transform_single_block(
+        fix_slices, transform_slices, transform_origin, mov_slices,
+        output_slices, transform_list, corners,
+    ):
+
+        # read fix
+        fix = fix_reader(fix_slices)
+        ndim = len(fix_slices)
+        fix_start = np.fromiter((s.start for s in fix_slices), dtype=int, count=ndim)
+        fix_stop = np.fromiter((s.stop for s in fix_slices), dtype=int, count=ndim)
+        fix_origin = fix_spacing * fix_start
+
+        # read relevant region of transforms
+        transform_list = [
+            transform if slices is None else _as_float(transform(slices))
+            for transform, slices in zip(transform_list, transform_slices)
+        ]
+
+        # transform fixed block corners if not done already, read moving data
+        if mov_slices is None:
+            fix_block_coords = np.where(corners, fix_stop - 1, fix_start) * fix_spacing
+            mov_block_coords = bs_transform.apply_transform_to_coordinates(
+                fix_block_coords, transform_list, kwargs['transform_spacing'], transform_origin,
+            )
+            mov_start, mov_stop = _get_moving_bounds(
+                mov_block_coords, mov_spacing, mov_shape,
+            )
+            mov_slices = tuple(slice(a, b) for a, b in zip(mov_start, mov_stop))
+        mov = mov_reader(mov_slices)
         mov_origin = mov_spacing * [s.start for s in mov_slices]
 
         # resample
@@ -179,42 +228,83 @@ def distributed_apply_transform(
         )
 
         # crop out overlap
-        for axis in range(aligned.ndim):
-
-            # left side
-            slc = [slice(None),]*aligned.ndim
-            if fix_slices[axis].start != 0:
-                slc[axis] = slice(overlap[axis], None)
-                aligned = aligned[tuple(slc)]
+        crop_start = np.where(fix_start != 0, overlap, 0)
+        crop_stop = crop_start + np.minimum(aligned.shape - crop_start, blocksize)
+        aligned = aligned[tuple(slice(a, b) for a, b in zip(crop_start, crop_stop))]
 
-            # right side
-            slc = [slice(None),]*aligned.ndim
-            if aligned.shape[axis] > blocksize[axis]:
-                slc[axis] = slice(None, blocksize[axis])
-                aligned = aligned[tuple(slc)]
-
-        # return result
-        return aligned
+        # handle output
+        if output_zarr is None:
+            return aligned
+        else:
+            output_zarr[output_slices] = aligned
+            return True
     # END: closure
 
-    # align all blocks
-    aligned = da.map_blocks(
+    # create output array, unless the result is assembled in memory
+    output_zarr = None
+    if write_path:
+        output_zarr = zarr.create(
+            shape=fix_zarr.shape,
+            chunks=tuple(blocksize),
+            dtype=fix_zarr.dtype,
+            store=write_path,
+            path=dataset_path,
+        )
+
+    # align all blocks, one task per block
+    # blocks are submitted in Z-order so spatial neighbors, which read
+    # overlapping regions of the inputs, run close together in time
+    block_indices = list(block_coords.keys())
+    block_order = np.argsort(ut.morton_order(block_indices), kind='stable')
+    block_indices = [block_indices[iii] for iii in block_order]
+    futures = cluster.client.map(
         transform_single_block,
-        block_coords,
-        transform_list=transform_list,
-        dtype=fix_zarr.dtype,
-        chunks=blocksize,
+        *zip(*[block_coords[index] for index in block_indices]),
+        [mov_block_slices[index] for index in block_indices],
+        [output_slices[index] for index in block_indices],
+        transform_list=transform_readers,
+        corners=corners,
     )
 
-    # crop to original size
-    aligned = aligned[tuple(slice(s) for s in fix_zarr.shape)]
-
-    # return
+    # assemble the output, blocks are released as soon as they are received
     if write_path:
-        da.to_zarr(aligned, write_path, component=dataset_path)
-        return zarr.open(write_path, 'r+')
+        all_written = np.all(cluster.client.gather(futures))
+        aligned = zarr.open(write_path, 'r+')
     else:
-        return aligned.compute()
+        future_slices = {
+            f.key: output_slices[index] for f, index in zip(futures, block_indices)
+        }
+        completed = as_completed(futures, with_results=True)
+        del futures
+        aligned = np.empty(fix_zarr.shape, dtype=fix_zarr.dtype)
+        for batch in completed.batches():
+            for future, result in batch:
+                aligned[future_slices[future.key]] = result
+
+    # release the deform chunks cached on the workers
+    cluster.client.run(io_utility.clear_zarr_cache)
+    return aligned
+
+
+def _get_moving_bounds(mov_block_coords, mov_spacing, mov_shape):
+    """
+    Voxel bounds of the moving image region containing the transformed
+    corners of one block (8xd array) or of many blocks (Nx8xd array)
+    """
+    mov_block_coords = mov_block_coords / mov_spacing
+    np.rint(mov_block_coords, out=mov_block_coords)
+    np.clip(mov_block_coords, 0, mov_shape, out=mov_block_coords)
+    mov_block_coords = mov_block_coords.astype(int)
+    mov_start = np.min(mov_block_coords, axis=-2)
+    mov_stop = np.max(mov_block_coords, axis=-2)
+    return mov_start, mov_stop
+
+
+def _as_float(array):
+    """
+    Cast reduced precision data read from disk to at least single precision
+    """
+    return array.astype(np.result_type(array.dtype, np.float32), copy=False)
 
 
 @cluster
@@ -305,17 +395,11 @@ def distributed_apply_transform_to_coordinates(
     origin = np.min(coordinates, axis=0)
     nblocks = np.max(coordinates, axis=0) - origin
     nblocks = np.ceil(nblocks / partition_size).astype(int)
-    partitions, indices = [], []
-    for index in np.ndindex(*nblocks):
-        lower_bound = origin + partition_size * np.array(index)
-        upper_bound = lower_bound + partition_size
-        not_too_low = np.all(coordinates >= lower_bound, axis=1)
-        not_too_high = np.all(coordinates < upper_bound, axis=1)
-        part_indices = np.nonzero( not_too_low * not_too_high )[0]
-        if part_indices.size != 0:
-            partitions.append(coordinates[part_indices])
-            indices.append(part_indices)
-    indices = np.concatenate(indices, axis=0)
+    _, part_indices = ut.partition_coordinates(
+        coordinates, origin, partition_size, nblocks,
+    )
+    partitions = [coordinates[x] for x in part_indices]
+    indices = np.concatenate(part_indices, axis=0)
 
     def transform_partition(coordinates, transform_list):
 
@@ -365,6 +449,9 @@ def distributed_invert_displacement_vector_field(
     sqrt_order=2,
     sqrt_step=0.5,
     sqrt_iterations=5,
+    blocks_per_task=1,
+    field_dtype=None,
+    return_numpy=True,
     cluster=None,
     cluster_kwargs={},
     temporary_directory=None,
@@ -385,8 +472,7 @@ def distributed_invert_displacement_vector_field(
 
     write_path : string (default: None)
         Location on disk to write the inverted displacement field
-        If None, then the inverted transform is returned in memory
-        to the client process (make sure you have enough RAM if you do this!)
+        If None, see return_numpy
 
     step : float (default: 0.5)
         The step size used for each iteration of the stationary point algorithm
@@ -404,6 +490,26 @@ def distributed_invert_displacement_vector_field(
     sqrt_iterations : scalar int (default: 5)
         The number of iterations to find the field composition square root.
 
+    blocks_per_task : scalar int (default: 1)
+        The number of adjacent blocks along each axis that are inverted by
+        a single task. The default runs one task per block. Larger values
+        mean fewer tasks for the scheduler to track, at the cost of coarser
+        parallelism.
+
+    field_dtype : a numpy.dtype object (default: None)
+        The data type of the temporary zarr copy made of the field if it is
+        given as a numpy array, e.g. np.float16 to halve the data read for
+        every block. The field is cast back to at least single precision when
+        read and the inverse keeps the data type of the given field.
+        If None the copy keeps the data type of the field.
+
+    return_numpy : bool (default: True)
+        Only used if write_path is None. If True, the inverse is assembled in
+        memory on the client process and returned as a numpy array (make sure
+        you have enough RAM if you do this!). If False, blocks are streamed as
+        they finish to a zarr array in its own folder within the
+        `temporary_directory`, which is not removed, and that array is returned.
+
     cluster : ClusterWrap.cluster object (default: None)
         Only set if you have constructed your own static cluster. The default behavior
         is to construct a cluster for the duration of this function, then close it
@@ -424,25 +530,34 @@ def distributed_invert_displacement_vector_field(
 
     Returns
     -------
-    inverse_field : zarr array
-        The numerical inverse of the given displacement vector field as a zarr array.
+    inverse_field : zarr array or numpy array
+        The numerical inverse of the given displacement vector field. A numpy
+        array if write_path is None and return_numpy is True, otherwise a zarr array.
     """
 
     # ensure input field is zarr
+    temporary_parent = temporary_directory or os.getcwd()
     temporary_directory = tempfile.TemporaryDirectory(
-        prefix='.', dir=temporary_directory or os.getcwd(),
+        prefix='.', dir=temporary_parent,
     )
     zarr_blocks = tuple(blocksize) + (field.shape[-1],)
     field_zarr_path = temporary_directory.name + '/field.zarr'
-    field_zarr = ut.numpy_to_zarr(field, zarr_blocks, field_zarr_path)
+    field_zarr = ut.numpy_to_zarr(
+        field, zarr_blocks, field_zarr_path, dtype=field_dtype,
+    )
 
-    # create output array
-    if write_path:
+    # create output array, unless the inverse is assembled in memory
+    inverse_dtype = field.dtype
+    in_memory = not write_path and return_numpy
+    if not write_path and not return_numpy:
+        write_path = tempfile.mkdtemp(prefix='.', dir=temporary_parent)
+        write_path = write_path + '/inverse.zarr'
+    if not in_memory:
         output_zarr = ut.create_zarr(
             write_path,
             field_zarr.shape,
             zarr_blocks,
-            field_zarr.dtype,
+            inverse_dtype,
         )
 
     # get overlap and number of blocks
@@ -451,27 +566,36 @@ def distributed_invert_displacement_vector_field(
     nblocks = np.ceil(np.array(field_zarr.shape[:-1]) / blocksize).astype(int)
 
     # determine block coordinates
-    block_coords = []
-    block_coords_overlaps = []
-    for (i, j, k) in np.ndindex(*nblocks):
-        start = blocksize * (i, j, k)
-        stop = start + blocksize
-        start_ol = start - overlap
-        stop_ol = stop + overlap
-
-        start_ol = np.maximum(0, start_ol)
-        stop = np.minimum(field_zarr.shape[:-1], stop)
-        stop_ol = np.minimum(field_zarr.shape[:-1], stop_ol)
-
-        coords = tuple(slice(x, y) for x, y in zip(start, stop))
-        coords_ol = tuple(slice(x, y) for x, y in zip(start_ol, stop_ol))
-        block_coords.append(coords)
-        block_coords_overlaps.append(coords_ol)
+    block_indices, slices, slices_overlaps = ut.get_blocks_coords(
+        field_zarr.shape[:-1], blocksize, overlap,
+    )
+    block_coords = {
+        tuple(index): (a, b)
+        for index, a, b in zip(block_indices.tolist(), slices, slices_overlaps)
+    }
+
+    # group adjacent blocks into super blocks, one task per super block
+    # super blocks are listed in Z-order, so spatial neighbors, which read
+    # overlapping regions of the field, are submitted close together
+    nsuperblocks = np.ceil(nblocks / blocks_per_task).astype(int)
+    superblock_indices = np.indices(nsuperblocks).reshape(len(nsuperblocks), -1).T
+    superblock_order = np.argsort(ut.morton_order(superblock_indices), kind='stable')
+    superblock_coords, superblock_members = [], []
+    for index in superblock_indices[superblock_order]:
+        first = index * blocks_per_task
+        last = np.minimum(first + blocks_per_task, nblocks)
+        members = [
+            block_coords[tuple(first + x)] for x in np.ndindex(*(last - first))
+        ]
+        superblock_coords.append(tuple(
+            slice(a.start, b.stop) for a, b in zip(members[0][0], members[-1][0])
+        ))
+        superblock_members.append(members)
 
     # the function to run on every block
     def invert_block(slices, slices_overlaps):
 
-        field = field_zarr[slices_overlaps]
+        field = _as_float(field_zarr[slices_overlaps])
         inverse = bs_transform.invert_displacement_vector_field(
             field,
             spacing,
@@ -497,28 +621,49 @@ def distributed_invert_displacement_vector_field(
                 slc[axis] = slice(None, blocksize[axis])
                 inverse = inverse[tuple(slc)]
 
+        return inverse
+
+    # invert all blocks of a super block and assemble them locally
+    def invert_superblock(superblock_slices, members):
+
+        inverse = np.empty(
+            tuple(s.stop - s.start for s in superblock_slices) + (field_zarr.shape[-1],),
+            dtype=inverse_dtype,
+        )
+        for slices, slices_overlaps in members:
+            offset = tuple(
+                slice(a.start - b.start, a.stop - b.start)
+                for a, b in zip(slices, superblock_slices)
+            )
+            inverse[offset] = invert_block(slices, slices_overlaps)
+
         # handle output
-        if not write_path:
+        if in_memory:
             return inverse
         else:
-            output_zarr[slices] = inverse
+            output_zarr[superblock_slices] = inverse
             return True
 
-    # submit all blocks
+    # submit all super blocks
     futures = cluster.client.map(
-        invert_block,
-        block_coords,
-        block_coords_overlaps,
+        invert_superblock,
+        superblock_coords,
+        superblock_members,
     )
 
     # reconstruct output if necessary
-    if not write_path:
-        future_keys = [f.key for f in futures]
-        inverse = np.zeros_like(field)
-        for batch in as_completed(futures, with_results=True).batches():
+    # super blocks are released as soon as they are received, and the inverse
+    # is only allocated once the first one arrives
+    if in_memory:
+        future_slices = {f.key: s for f, s in zip(futures, superblock_coords)}
+        completed = as_completed(futures, with_results=True)
+        del futures
+        inverse = None
+        for batch in completed.batches():
             for future, result in batch:
-                iii = future_keys.index(future.key)
-                inverse[block_coords[iii]] = result
+                if inverse is None:
+                    inverse = np.empty(field.shape, dtype=inverse_dtype)
+                inverse[future_slices[future.key]] = result
         return inverse
     else:
         all_written = np.all(cluster.client.gather(futures))
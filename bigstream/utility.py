@@ -447,6 +447,132 @@ def relative_spacing(query_shape, reference_shape, reference_spacing):
 
 
 
+def partition_coordinates(coordinates, origin, partition_size, nblocks):
+    """
+    Assign coordinates to the cells of a regular grid of partitions
+
+    Parameters
+    ----------
+    coordinates : Nxd array
+        The coordinates to partition
+
+    origin : 1d array
+        The coordinate of the lower corner of the first partition
+
+    partition_size : scalar or 1d array
+        The size of one partition, in the same units as coordinates
+
+    nblocks : tuple
+        The number of partitions along each axis. Coordinates outside
+        the grid are assigned to the nearest partition
+
+    Returns
+    -------
+    partition_indexes : Kxd array
+        The grid index of each non-empty partition, in C order
+
+    coordinate_indexes : list of K 1d arrays
+        The (ascending) row indexes in coordinates of the points
+        that fall in each non-empty partition
+    """
+
+    nblocks = np.maximum(1, np.array(nblocks, dtype=int))
+    bins = np.floor((coordinates - origin) / partition_size).astype(int)
+    bins = np.clip(bins, 0, nblocks - 1)
+    flat_bins = np.ravel_multi_index(tuple(bins.T), nblocks)
+    order = np.argsort(flat_bins, kind='stable')
+    flat_indexes, starts = np.unique(flat_bins[order], return_index=True)
+    partition_indexes = np.stack(np.unravel_index(flat_indexes, nblocks), axis=-1)
+    return partition_indexes, np.split(order, starts[1:])
+
+
+def morton_order(indices):
+    """
+    Position of grid indices along a Z-order (Morton) curve. Sorting
+    blocks by this value visits spatial neighbors close together in time
+
+    Parameters
+    ----------
+    indices : Nxd array of int
+        Nonnegative grid indices. N such indices in d dimensions
+
+    Returns
+    -------
+    order : 1d array of int
+        The Morton code of each index, formed by interleaving the bits of
+        its components
+    """
+
+    indices = np.asarray(indices, dtype=np.uint64)
+    ndim = indices.shape[1]
+    nbits = int(indices.max()).bit_length() if indices.size else 0
+    order = np.zeros(len(indices), dtype=np.uint64)
+    for bit in range(nbits):
+        for axis in range(ndim):
+            component = (indices[:, axis] >> np.uint64(bit)) & np.uint64(1)
+            order |= component << np.uint64(bit * ndim + ndim - 1 - axis)
+    return order.astype(np.int64)
+
+
+def block_corners(ndim):
+    """
+    Which of start or stop each corner of a block takes along each axis
+
+    Parameters
+    ----------
+    ndim : int
+        The number of dimensions of the block
+
+    Returns
+    -------
+    corners : 2**ndim x ndim array of bool
+        True where a corner takes the stop of the block along an axis
+    """
+
+    return np.indices((2,) * ndim).reshape(ndim, -1).T.astype(bool)
+
+
+def get_blocks_coords(shape, blocksize, overlaps=0):
+    """
+    Grid indices and slices of the blocks that partition an image
+
+    Parameters
+    ----------
+    shape : tuple
+        The shape of the image
+
+    blocksize : 1d array of int
+        The shape of the blocks in voxels
+
+    overlaps : 1d array of int or int (default: 0)
+        The number of voxels each block is extended by on each side
+
+    Returns
+    -------
+    indices : Nxd array of int
+        The grid index of every block, in C order
+
+    slices : list of tuples of slices
+        The region of every block, clipped to shape
+
+    slices_overlaps : list of tuples of slices
+        The region of every block extended by overlaps, clipped to shape
+    """
+
+    nblocks = np.ceil(np.array(shape) / blocksize).astype(int)
+    indices = np.indices(nblocks).reshape(len(nblocks), -1).T
+    starts = indices * blocksize
+    stops = np.minimum(shape, starts + blocksize)
+    starts_overlaps = np.maximum(0, starts - overlaps)
+    stops_overlaps = np.minimum(shape, starts + blocksize + overlaps)
+    slices = [tuple(map(slice, a, b))
+              for a, b in zip(starts.tolist(), stops.tolist())]
+    slices_overlaps = [tuple(map(slice, a, b))
+                       for a, b in zip(starts_overlaps.tolist(),
+                                       stops_overlaps.tolist())]
+    return indices, slices, slices_overlaps
+
+
 def transform_list_to_composite_transform(transform_list, spacing=None, origin=None):
     """
     Convert a list of transforms to a sitk.CompositeTransform object
@@ -554,7 +680,7 @@ def create_zarr(
     return zarr_disk
 
 
-def numpy_to_zarr(array, chunks, path):
+def numpy_to_zarr(array, chunks, path, dtype=None):
     """
     Convert a numpy array to a zarr array on disk
 
@@ -569,6 +695,10 @@ def numpy_to_zarr(array, chunks, path):
     path : string
         On disk location to create the zarr array
 
+    dtype : a numpy.dtype object (default: None)
+        The data type of the zarr array copy. If None, the data type of
+        the given array is used. Ignored if array is already a zarr array.
+
     Returns
     -------
     zarr_array : zarr array
@@ -576,7 +706,7 @@ def numpy_to_zarr(array, chunks, path):
     """
 
     if not isinstance(array, zarr.Array):
-        zarr_disk = create_zarr(path, array.shape, chunks, array.dtype)
+        zarr_disk = create_zarr(path, array.shape, chunks, dtype or array.dtype)
         zarr_disk[...] = array
         return zarr_disk
     else: